@@ -5,13 +5,18 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
 from datetime import datetime, timezone
+import logging
 import os
 from dotenv import load_dotenv
 from typing import Union
 from pydantic import BaseModel
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -22,11 +27,57 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Motor binds to the running event loop on first use, so one module-level
+    # client gives each worker a single shared connection pool.
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=100,
+        minPoolSize=10,
+        waitQueueTimeoutMS=2000,
+        serverSelectionTimeoutMS=3000,
+        # Decode datetimes as UTC-aware so they compare with aware values such as
+        # datetime.now(timezone.utc); naive ones raise TypeError in those comparisons
+        tz_aware=True,
+    )
     db = _client[database_name]
 
+def close_client():
+    """Close the shared client and its connection pool"""
+    if _client is not None:
+        _client.close()
+
+# Open-task filter shared by queries and the partial index; keep them identical
+# so the planner can select the partial index
+OPEN_TASK_STATUSES = ["todo", "in_progress"]
+
+# Open-task ordering used by auto_schedule's sort
+_OPEN_TASK_SORT_KEY = [("priority_rank", 1), ("deadline", 1), ("estimate_minutes", 1)]
+_FULL_TASK_INDEX = [("status", 1), *_OPEN_TASK_SORT_KEY]
+
+async def ensure_indexes():
+    """Create indexes backing the hot query shapes (idempotent)"""
+    if db is None:
+        return
+    await db.timeblock.create_index([("start", 1)])
+    # $in in partialFilterExpression needs MongoDB 6.0+; older servers fall back to
+    # the full (status, ...) compound index
+    try:
+        await db.task.create_index(
+            _OPEN_TASK_SORT_KEY,
+            partialFilterExpression={"status": {"$in": OPEN_TASK_STATUSES}},
+        )
+    except OperationFailure as e:
+        logger.warning("Partial open-task index unavailable (requires MongoDB 6.0+), using full index: %s", e)
+        await db.task.create_index(_FULL_TASK_INDEX)
+        return
+    # The partial index serves every open-task query; keep writes to a single index
+    try:
+        await db.task.drop_index(_FULL_TASK_INDEX)
+    except OperationFailure:
+        pass  # not present
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,16 +91,65 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
+async def create_documents(collection_name: str, items: list, ordered: bool = False):
+    """Insert many documents with timestamps in a single round-trip"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    if not items:
+        return []
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        docs.append(data_dict)
+
+    result = await db[collection_name].insert_many(docs, ordered=ordered)
+    return [str(_id) for _id in result.inserted_ids]
+
+async def get_documents(
+    collection_name: str,
+    filter_dict: dict = None,
+    limit: int = None,
+    projection: dict = None,
+    sort: list = None,
+):
+    """Get documents from collection, optionally projected and sorted server-side"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
     
-    cursor = db[collection_name].find(filter_dict or {})
+    cursor = db[collection_name].find(filter_dict or {}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(None)
+
+async def get_documents_in(collection_name: str, field: str, values: list, projection: dict = None):
+    """Get all documents whose field matches any of values, in one query.
+
+    Use this (or get_by_ids) when resolving references for a list of documents
+    instead of querying once per document (N+1).
+    """
+    if not values:
+        return []
+    return await get_documents(collection_name, {field: {"$in": list(values)}}, projection=projection)
+
+async def get_by_ids(collection_name: str, ids: list, projection: dict = None):
+    """Batch-fetch documents by string id, returned as {id: document}"""
+    object_ids = [ObjectId(i) for i in set(ids) if i and ObjectId.is_valid(i)]
+    docs = await get_documents_in(collection_name, "_id", object_ids, projection=projection)
+    return {str(d["_id"]): d for d in docs}
+
+async def aggregate_documents(collection_name: str, pipeline: list, limit: int = None):
+    """Run an aggregation pipeline and return the resulting documents"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    return await db[collection_name].aggregate(pipeline).to_list(limit)
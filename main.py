@@ -1,23 +1,127 @@
+import asyncio
+import logging
 import os
+import time
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Any, Dict
 
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
+import orjson
+from bson import ObjectId
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 
 # Database helpers
-from database import db, create_document, get_documents
+from database import (
+    db,
+    create_document,
+    create_documents,
+    get_documents,
+    aggregate_documents,
+    ensure_indexes,
+    close_client,
+    OPEN_TASK_STATUSES,
+)
 
-app = FastAPI(title="Smart Timetable & Productivity API")
+class UTCORJSONResponse(ORJSONResponse):
+    """ORJSONResponse writing UTC datetimes with a Z suffix, matching pydantic's output."""
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_UTC_Z,
+        )
+
+app = FastAPI(title="Smart Timetable & Productivity API", default_response_class=UTCORJSONResponse)
+
+# ------------------------------
+# CORS
+# ------------------------------
+
+# Allow-all policy with credentials, equivalent to CORSMiddleware(allow_origins=["*"],
+# allow_credentials=True, allow_methods=["*"], allow_headers=["*"]) but with headers
+# built once instead of per request.
+_CORS_WILDCARD = (b"access-control-allow-origin", b"*")
+_CORS_CREDENTIALS = (b"access-control-allow-credentials", b"true")
+_CORS_VARY = (b"vary", b"Origin")
+_CORS_PREFLIGHT = [
+    (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+    (b"access-control-max-age", b"600"),
+    _CORS_CREDENTIALS,
+    _CORS_VARY,
+    (b"content-type", b"text/plain; charset=utf-8"),
+    (b"content-length", b"2"),
+]
+
+class WildcardCORSMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        origin = request_method = request_headers = None
+        has_cookie = False
+        for key, value in scope["headers"]:
+            if key == b"origin":
+                origin = value
+            elif key == b"cookie":
+                has_cookie = True
+            elif key == b"access-control-request-method":
+                request_method = value
+            elif key == b"access-control-request-headers":
+                request_headers = value
+
+        # Not a cross-origin request
+        if origin is None:
+            return await self.app(scope, receive, send)
+
+        if scope["method"] == "OPTIONS" and request_method is not None:
+            headers = [(b"access-control-allow-origin", origin), *_CORS_PREFLIGHT]
+            if request_headers is not None:
+                headers.append((b"access-control-allow-headers", request_headers))
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            await send({"type": "http.response.body", "body": b"OK"})
+            return
+
+        # Credentialed requests cannot use the wildcard, so echo the origin back
+        cors_headers = (
+            [(b"access-control-allow-origin", origin), _CORS_CREDENTIALS, _CORS_VARY]
+            if has_cookie else [_CORS_WILDCARD, _CORS_CREDENTIALS]
+        )
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), *cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(WildcardCORSMiddleware)
+
+logger = logging.getLogger(__name__)
+
+# Index creation runs in the background: the routes work without the indexes
+# (just slower), so an unreachable DB at boot must not keep the app from starting.
+_index_task: Optional[asyncio.Task] = None
+
+async def _ensure_indexes_logged():
+    try:
+        await ensure_indexes()
+    except Exception as e:
+        logger.warning("Index creation failed, continuing without indexes: %s", e)
+
+@app.on_event("startup")
+async def _create_indexes():
+    global _index_task
+    _index_task = asyncio.create_task(_ensure_indexes_logged())
+
+@app.on_event("shutdown")
+async def _close_client():
+    if _index_task is not None and not _index_task.done():
+        _index_task.cancel()
+    close_client()
 
 # ------------------------------
 # Utility helpers
@@ -32,6 +136,44 @@ def _to_doc(doc: Dict[str, Any]):
         d["id"] = str(d.pop("_id"))
     return d
 
+def _duration_penalty(estimate_minutes: int) -> float:
+    """Recommendation penalty for long tasks; stored on write since it only depends on the estimate."""
+    return max(0.0, (estimate_minutes - 30) / 30.0) * 0.2
+
+def _id_to_str(doc: Dict[str, Any]):
+    """In-place variant of _to_doc for freshly fetched documents."""
+    doc["id"] = str(doc.pop("_id"))
+    return doc
+
+def _page_filter(cursor: Optional[str]) -> Dict[str, Any]:
+    """Keyset filter for newest-first pages: documents older than the cursor id."""
+    if cursor is None:
+        return {}
+    if not ObjectId.is_valid(cursor):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"_id": {"$lt": ObjectId(cursor)}}
+
+# Priority order: urgent > high > medium > low (stored on tasks as priority_rank)
+_PRIO_RANK = {"urgent": 0, "high": 1, "medium": 2, "low": 3}
+# Sort sentinel for tasks without a deadline
+_FAR_FUTURE = datetime.max.replace(tzinfo=timezone.utc)
+
+# Fields read back by the endpoints; projecting them keeps unused payload on the server
+_TASK_FIELDS = {f: 1 for f in (
+    "title", "description", "project", "estimate_minutes", "energy",
+    "priority", "deadline", "tags", "status",
+)}
+_TIMEBLOCK_FIELDS = {f: 1 for f in ("task_id", "title", "start", "end", "status", "context")}
+_TASK_DEFAULTS = {
+    "description": None, "project": None, "estimate_minutes": 30, "energy": None,
+    "priority": "medium", "deadline": None, "tags": [], "status": "todo",
+}
+_TIMEBLOCK_DEFAULTS = {"task_id": None, "status": "planned", "context": None}
+_SCHEDULE_TASK_FIELDS = {f: 1 for f in (
+    "title", "project", "estimate_minutes", "priority", "priority_rank", "deadline", "tags",
+)}
+_RECOMMEND_TASK_FIELDS = {f: 1 for f in ("title", "priority", "deadline", "estimate_minutes", "duration_penalty")}
+
 # ------------------------------
 # Pydantic models (request bodies)
 # ------------------------------
@@ -70,11 +212,18 @@ class RecommendResponse(BaseModel):
 # ------------------------------
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Smart Timetable & Productivity API running"}
 
-@app.get("/test")
-def test_database():
+# Health-check floods are served from a short-lived cache (one listCollections per window).
+# Concurrent misses share a single in-flight probe instead of each querying Mongo.
+_TEST_CACHE_TTL = 5.0
+_test_cached_at = 0.0
+_test_cached_resp: Optional[Dict[str, Any]] = None
+_test_inflight: Optional[asyncio.Task] = None
+
+async def _probe_database() -> Dict[str, Any]:
+    global _test_cached_at, _test_cached_resp
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -88,77 +237,85 @@ def test_database():
             response["database"] = "✅ Available"
             response["connection_status"] = "Connected"
             try:
-                cols = db.list_collection_names()
+                cols = await db.list_collection_names()
                 response["collections"] = cols
                 response["database"] = "✅ Connected & Working"
+                _test_cached_at, _test_cached_resp = time.monotonic(), response
             except Exception as e:
+                _test_cached_resp = None
                 response["database"] = f"⚠️ Connected but error: {str(e)[:80]}"
         else:
             response["database"] = "⚠️ Available but not initialized"
     except Exception as e:
+        _test_cached_resp = None
         response["database"] = f"❌ Error: {str(e)[:80]}"
     return response
 
+def _clear_test_inflight(task: asyncio.Task):
+    global _test_inflight
+    if _test_inflight is task:
+        _test_inflight = None
+
+@app.get("/test")
+async def test_database():
+    global _test_inflight
+    if _test_cached_resp is not None and time.monotonic() - _test_cached_at < _TEST_CACHE_TTL:
+        response = _test_cached_resp
+    else:
+        if _test_inflight is None:
+            _test_inflight = asyncio.create_task(_probe_database())
+            _test_inflight.add_done_callback(_clear_test_inflight)
+        # shield: a disconnecting client must not cancel the probe other requests await
+        response = await asyncio.shield(_test_inflight)
+    return {**response, "collections": list(response["collections"])}
+
 # ------------------------------
 # Tasks
 # ------------------------------
 
 @app.get("/tasks", response_model=List[Task])
-def list_tasks():
-    docs = get_documents("task", {}) if db else []
-    results = []
-    for d in docs:
-        d = _to_doc(d)
-        results.append(Task(
-            id=d.get("id"),
-            title=d.get("title"),
-            description=d.get("description"),
-            project=d.get("project"),
-            estimate_minutes=d.get("estimate_minutes", 30),
-            energy=d.get("energy"),
-            priority=d.get("priority", "medium"),
-            deadline=d.get("deadline"),
-            tags=d.get("tags", []),
-            status=d.get("status", "todo"),
-        ))
-    return results
+async def list_tasks(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="id of the last task from the previous page"),
+):
+    docs = await get_documents(
+        "task", _page_filter(cursor), limit=limit, projection=_TASK_FIELDS, sort=[("_id", -1)]
+    ) if db is not None else []
+    # Trusted DB data: serialize straight to JSON, bypassing model validation
+    return UTCORJSONResponse([{**_TASK_DEFAULTS, **_id_to_str(d)} for d in docs])
 
 @app.post("/tasks", response_model=Task)
-def create_task(task: TaskIn):
+async def create_task(task: TaskIn):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
     data = task.model_dump()
     data["status"] = "todo"
-    inserted_id = create_document("task", data)
-    return Task(id=inserted_id, status="todo", **task.model_dump())
+    data["priority_rank"] = _PRIO_RANK.get(data["priority"], 2)
+    data["duration_penalty"] = _duration_penalty(data["estimate_minutes"])
+    inserted_id = await create_document("task", data)
+    # data is already validated and carries status; the stored-only fields are ignored
+    return Task.model_construct(id=inserted_id, **data)
 
 # ------------------------------
 # Timeblocks & Scheduling
 # ------------------------------
 
 @app.get("/timeblocks", response_model=List[TimeBlock])
-def list_timeblocks():
-    docs = get_documents("timeblock", {}) if db else []
-    results: List[TimeBlock] = []
-    for d in docs:
-        d = _to_doc(d)
-        results.append(TimeBlock(
-            id=d.get("id"),
-            task_id=d.get("task_id"),
-            title=d.get("title"),
-            start=d.get("start"),
-            end=d.get("end"),
-            status=d.get("status", "planned"),
-            context=d.get("context"),
-        ))
-    return results
+async def list_timeblocks(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="id of the last timeblock from the previous page"),
+):
+    docs = await get_documents(
+        "timeblock", _page_filter(cursor), limit=limit, projection=_TIMEBLOCK_FIELDS, sort=[("_id", -1)]
+    ) if db is not None else []
+    return UTCORJSONResponse([{**_TIMEBLOCK_DEFAULTS, **_id_to_str(d)} for d in docs])
 
 class AutoScheduleRequest(BaseModel):
     start: Optional[datetime] = None
     end: Optional[datetime] = None
 
 @app.post("/schedule/auto", response_model=List[TimeBlock])
-def auto_schedule(req: AutoScheduleRequest):
+async def auto_schedule(req: AutoScheduleRequest):
     """Very simple heuristic: fill from now across free time in 30-120m blocks."""
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
@@ -167,19 +324,24 @@ def auto_schedule(req: AutoScheduleRequest):
     start = req.start or now
     end = req.end or (start + timedelta(hours=8))
 
-    # Fetch tasks not done
-    tasks = [ _to_doc(t) for t in get_documents("task", {"status": {"$ne": "done"}}) ]
+    # Fetch open tasks ($in is index-friendly, unlike $ne)
+    tasks = [ _to_doc(t) for t in await get_documents(
+        "task",
+        {"status": {"$in": OPEN_TASK_STATUSES}},
+        projection=_SCHEDULE_TASK_FIELDS,
+        sort=[("priority_rank", 1), ("deadline", 1), ("estimate_minutes", 1)],
+    ) ]
 
-    # Priority order: urgent > high > medium > low, then earliest deadline, then estimate asc
-    prio_rank = {"urgent": 0, "high": 1, "medium": 2, "low": 3}
+    # Mongo returns the index order; this stable pass only moves deadline-less tasks
+    # after dated ones (Mongo sorts nulls first) and ranks tasks written before priority_rank.
     tasks.sort(key=lambda t: (
-        prio_rank.get(t.get("priority", "medium"), 2),
-        t.get("deadline") or datetime.max.replace(tzinfo=timezone.utc),
+        t.get("priority_rank", _PRIO_RANK.get(t.get("priority", "medium"), 2)),
+        t.get("deadline") or _FAR_FUTURE,
         t.get("estimate_minutes", 30)
     ))
 
     cursor = start
-    created_blocks: List[TimeBlock] = []
+    blocks: List[Dict[str, Any]] = []
     for t in tasks:
         est = int(t.get("estimate_minutes", 30))
         block_start = cursor
@@ -194,38 +356,58 @@ def auto_schedule(req: AutoScheduleRequest):
             "status": "planned",
             "context": t.get("project") or ",".join(t.get("tags", [])) or None,
         }
-        inserted_id = create_document("timeblock", tb)
-        created_blocks.append(TimeBlock(id=inserted_id, **tb))
+        blocks.append(tb)
         cursor = block_end + timedelta(minutes=5)  # small buffer
 
-    return created_blocks
+    inserted_ids = await create_documents("timeblock", blocks)
+    return [TimeBlock(id=inserted_id, **tb) for inserted_id, tb in zip(inserted_ids, blocks)]
 
 # ------------------------------
 # Recommendations
 # ------------------------------
 
+def _recommend_pipeline(now: datetime, limit: int = 3) -> List[Dict[str, Any]]:
+    """Score open tasks server-side: priority + deadline proximity - duration penalty."""
+    hours_to_deadline = {"$divide": [{"$subtract": ["$deadline", now]}, 3600 * 1000]}
+    has_deadline = {"$eq": [{"$type": "$deadline"}, "date"]}
+    estimate = {"$ifNull": ["$estimate_minutes", 30]}
+    # Tasks written before duration_penalty was stored fall back to computing it
+    duration_penalty = {"$ifNull": [
+        "$duration_penalty",
+        {"$multiply": [0.2, {"$max": [0, {"$divide": [{"$subtract": [estimate, 30]}, 30]}]}]},
+    ]}
+    return [
+        {"$match": {"status": {"$in": OPEN_TASK_STATUSES}}},
+        {"$project": _RECOMMEND_TASK_FIELDS},
+        {"$addFields": {"score": {"$round": [{"$subtract": [{"$add": [
+            {"$switch": {
+                "branches": [
+                    {"case": {"$eq": ["$priority", "urgent"]}, "then": 4},
+                    {"case": {"$eq": ["$priority", "high"]}, "then": 3},
+                    {"case": {"$eq": ["$priority", "low"]}, "then": 1},
+                ],
+                "default": 2,
+            }},
+            {"$cond": [has_deadline, {"$switch": {
+                "branches": [
+                    {"case": {"$lt": [hours_to_deadline, 4]}, "then": 3},
+                    {"case": {"$lt": [hours_to_deadline, 24]}, "then": 2},
+                    {"case": {"$lt": [hours_to_deadline, 72]}, "then": 1},
+                ],
+                "default": 0,
+            }}, 0]},
+        ]}, duration_penalty]}, 2]}}},
+        {"$sort": {"score": -1, "_id": 1}},
+        {"$limit": limit},
+    ]
+
 @app.get("/recommend", response_model=RecommendResponse)
-def recommend_next():
+async def recommend_next():
     now = datetime.now(timezone.utc)
     suggestions: List[Dict[str, Any]] = []
-    if db:
-        tasks = [ _to_doc(t) for t in get_documents("task", {"status": {"$ne": "done"}}) ]
-        prio_weight = {"urgent": 4, "high": 3, "medium": 2, "low": 1}
+    if db is not None:
+        tasks = [ _to_doc(t) for t in await aggregate_documents("task", _recommend_pipeline(now), limit=3) ]
         for t in tasks:
-            # Simple score: priority + deadline proximity - duration penalty
-            base = prio_weight.get(t.get("priority", "medium"), 2)
-            deadline = t.get("deadline")
-            time_to_deadline = (deadline - now).total_seconds()/3600 if isinstance(deadline, datetime) else 1e6
-            urgency_bonus = 0
-            if isinstance(deadline, datetime):
-                if time_to_deadline < 4:
-                    urgency_bonus = 3
-                elif time_to_deadline < 24:
-                    urgency_bonus = 2
-                elif time_to_deadline < 72:
-                    urgency_bonus = 1
-            duration_penalty = max(0, (t.get("estimate_minutes", 30) - 30) / 30) * 0.2
-            score = base + urgency_bonus - duration_penalty
             suggestions.append({
                 "task": {
                     "id": t.get("id"),
@@ -234,13 +416,10 @@ def recommend_next():
                     "priority": t.get("priority", "medium"),
                     "deadline": t.get("deadline"),
                 },
-                "score": round(float(score), 2)
+                "score": float(t["score"])
             })
-        suggestions.sort(key=lambda s: s["score"], reverse=True)
-        suggestions = suggestions[:3]
     return RecommendResponse(now=now, suggestions=suggestions)
 
-
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))